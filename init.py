@@ -1,8 +1,20 @@
+import math
+import os
 import bpy
 import numpy as np
 from bpy.props import StringProperty, IntProperty, FloatProperty, EnumProperty, BoolProperty
 from bpy_extras.io_utils import ImportHelper
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
 bl_info = {
     "name": "Vertex Group from Texture",
     "author": "Hennie Kotze",
@@ -13,6 +25,17 @@ bl_info = {
     "category": "Mesh",
 }
 
+# Rec. 709 luminance weights, and the same in 8-bit fixed point (sum to 256)
+LUMA_COEFFS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+LUMA_Q8 = (54, 183, 19)
+
+# Greyscale plane of the most recently read file image, reused while the file is unchanged
+_GREY_CACHE = {}
+
+# Below this many loops the NumPy path finishes in tens of milliseconds, while the
+# first parallel kernel call spends seconds compiling (cached on disk afterwards)
+NUMBA_MIN_LOOPS = 5000000
+
 class VGBT_OT_create_groups(bpy.types.Operator, ImportHelper):
     bl_idname = "mesh.create_vertex_groups_from_texture"
     bl_label = "Create Vertex Groups from Texture"
@@ -121,16 +144,18 @@ class VGBT_OT_create_groups(bpy.types.Operator, ImportHelper):
             image = bpy.data.images.load(self.filepath)
         
         try:
+            greyscale = load_greyscale(image)
             if self.use_weights:
-                success = assign_weights_from_texture(context.object, image, self.weight_group_name, self.normalize_weights)
+                success = assign_weights_from_texture(context.object, greyscale, self.weight_group_name, self.normalize_weights)
                 if success:
                     self.report({'INFO'}, f"Created vertex group '{self.weight_group_name}' with weights from texture")
                 else:
                     self.report({'ERROR'}, "Failed to create vertex group. Check UV mapping.")
             else:
-                unique_colors = analyze_texture(image)
+                levels = greyscale_levels(greyscale)
+                unique_colors = analyze_texture(levels)
                 quantized_colors = quantize_colors(unique_colors, self.num_clusters)
-                success = assign_vertex_groups(context.object, quantized_colors, image, self.min_group_size, self.base_group_name)
+                success = assign_vertex_groups(context.object, quantized_colors, levels, self.min_group_size, self.base_group_name)
                 if success:
                     self.report({'INFO'}, f"Created vertex groups based on texture")
                 else:
@@ -156,83 +181,170 @@ class VGBT_PT_main_panel(bpy.types.Panel):
         layout = self.layout
         layout.operator("mesh.create_vertex_groups_from_texture")
 
-def analyze_texture(image):
-    pixels = np.array(image.pixels[:])
+def image_signature(image):
+    # Only images backed by a file on disk can be checked for changes
+    if image.source != 'FILE' or image.packed_file or image.is_dirty:
+        return None
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    try:
+        mtime = os.stat(filepath).st_mtime_ns
+    except OSError:
+        return None
+    return (tuple(image.size), image.channels, filepath, image.file_size, mtime,
+            image.colorspace_settings.name, image.alpha_mode)
+
+def load_greyscale(image):
+    signature = image_signature(image)
+    if signature is None:
+        return read_greyscale(image)
+    cached = _GREY_CACHE.get(image.name_full)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    greyscale = read_greyscale(image)
+    _GREY_CACHE.clear()
+    _GREY_CACHE[image.name_full] = (signature, greyscale)
+    return greyscale
+
+def read_greyscale(image):
     width, height, channels = image.size[0], image.size[1], image.channels
-    pixels = pixels.reshape((height, width, channels))
-    greyscale = np.mean(pixels[:, :, :3], axis=2) if channels > 1 else pixels[:, :, 0]
-    return np.unique(greyscale)
+    pixels = np.empty((height, width, channels), dtype=np.float32)
+    image.pixels.foreach_get(pixels.reshape(-1))  # Flat view aliases the contiguous buffer
+    if image.is_float:
+        # Keep high bit depth and HDR data at full precision for weights
+        greyscale = pixels[:, :, :3] @ LUMA_COEFFS if channels >= 3 else pixels[:, :, 0]
+        return np.ascontiguousarray(greyscale)
+    if channels < 3:
+        return np.rint(np.clip(pixels[:, :, 0], 0.0, 1.0) * 255).astype(np.uint8)
+    rgb = np.rint(np.clip(pixels[:, :, :3], 0.0, 1.0) * 255).astype(np.uint16)
+    greyscale = (rgb[:, :, 0] * LUMA_Q8[0] + rgb[:, :, 1] * LUMA_Q8[1] + rgb[:, :, 2] * LUMA_Q8[2] + 128) >> 8
+    return greyscale.astype(np.uint8)
+
+def greyscale_levels(greyscale):
+    if greyscale.dtype == np.uint8:
+        return greyscale
+    return np.rint(np.clip(greyscale, 0.0, 1.0) * 255).astype(np.uint8)
+
+def analyze_texture(greyscale):
+    histogram = np.bincount(greyscale.ravel(), minlength=256)
+    return np.nonzero(histogram)[0] / 255.0
 
 def quantize_colors(colors, num_clusters):
     min_color, max_color = np.min(colors), np.max(colors)
     bins = np.linspace(min_color, max_color, num_clusters + 1)
-    quantized_colors = (np.digitize(colors, bins) - 1) / (num_clusters - 1)
-    return np.unique(quantized_colors)
+    centers = (bins[:-1] + bins[1:]) / 2
+    bin_indices = np.clip(np.digitize(colors, bins) - 1, 0, num_clusters - 1)
+    return np.unique(centers[bin_indices])
 
-def assign_vertex_groups(obj, unique_colors, image, min_group_size, base_group_name):
-    mesh = obj.data
+def read_loops(mesh):
     if not mesh.uv_layers.active:
         raise ValueError("No active UV map found. Please ensure the object has an active UV map.")
 
     uv_layer = mesh.uv_layers.active.data
-    width, height = image.size
-    pixels = np.array(image.pixels[:]).reshape((height, width, image.channels))
-
-    vertex_group_assignments = {color: set() for color in unique_colors}
-
-    for poly in mesh.polygons:
-        for loop_idx in poly.loop_indices:
-            vertex_index = mesh.loops[loop_idx].vertex_index
-            uv = uv_layer[loop_idx].uv
-            x, y = int(uv.x * (width - 1)), int(uv.y * (height - 1))
-            pixel_value = np.mean(pixels[y, x]) if image.channels > 1 else pixels[y, x, 0]
-            closest_color = min(unique_colors, key=lambda c: abs(c - pixel_value))
-            vertex_group_assignments[closest_color].add(vertex_index)
+    loop_count = len(mesh.loops)
+    loop_vidx = np.empty(loop_count, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vidx)
+    uvs = np.empty(loop_count * 2, dtype=np.float32)
+    uv_layer.foreach_get("uv", uvs)
+    return loop_vidx, uvs.reshape(-1, 2)
+
+def sample_texture(greyscale, uvs):
+    # Nearest texel under the UV, clamped so UVs of exactly 1.0 hit the last texel
+    height, width = greyscale.shape
+    xs = np.clip(np.floor(uvs[:, 0] * width), 0, width - 1).astype(np.intp)
+    ys = np.clip(np.floor(uvs[:, 1] * height), 0, height - 1).astype(np.intp)
+    return np.take(greyscale.reshape(-1), ys * width + xs)
+
+def sample_texture_bilinear(greyscale, uvs):
+    # Texel centres sit at half-pixel offsets; wrap like Blender's default image extension
+    height, width = greyscale.shape
+    coords = np.stack([uvs[:, 1] * height - 0.5, uvs[:, 0] * width - 0.5])
+    return ndimage.map_coordinates(greyscale, coords, output=np.float32, order=1, mode='grid-wrap')
+
+def nearest_color_indices(unique_colors, values):
+    if len(unique_colors) == 1:
+        return np.zeros(len(values), dtype=np.intp)
+    idx = np.clip(np.searchsorted(unique_colors, values), 1, len(unique_colors) - 1)
+    left, right = unique_colors[idx - 1], unique_colors[idx]
+    choose_right = (values - left) > (right - values)
+    return idx - np.where(choose_right, 0, 1)
+
+def build_color_lut(unique_colors):
+    probe = np.arange(256) / 255.0
+    return nearest_color_indices(unique_colors, probe).astype(np.uint8)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def classify_loops(uvs, grey_flat, width, height, color_lut, out_bucket):
+        for i in numba.prange(uvs.shape[0]):
+            x = min(max(int(math.floor(uvs[i, 0] * width)), 0), width - 1)
+            y = min(max(int(math.floor(uvs[i, 1] * height)), 0), height - 1)
+            out_bucket[i] = color_lut[grey_flat[y * width + x]]
+
+def assign_vertex_groups(obj, unique_colors, greyscale, min_group_size, base_group_name):
+    loop_vidx, uvs = read_loops(obj.data)
+    color_lut = build_color_lut(unique_colors)
+    if numba is not None and len(loop_vidx) >= NUMBA_MIN_LOOPS:
+        nearest_idx = np.empty(len(loop_vidx), dtype=np.uint8)
+        height, width = greyscale.shape
+        classify_loops(uvs, greyscale.reshape(-1), width, height, color_lut, nearest_idx)
+    elif len(loop_vidx) > greyscale.size:
+        # Classifying every pixel once is cheaper than classifying every loop
+        nearest_idx = sample_texture(color_lut[greyscale], uvs)
+    else:
+        nearest_idx = color_lut[sample_texture(greyscale, uvs)]
+
+    order = np.argsort(nearest_idx, kind='stable')
+    sorted_vidx = loop_vidx[order]
+    edges = np.searchsorted(nearest_idx[order], np.arange(len(unique_colors) + 1))
 
     groups_created = 0
-    for color in sorted(vertex_group_assignments.keys()):
-        vertex_indices = vertex_group_assignments[color]
+    for start, end in zip(edges[:-1].tolist(), edges[1:].tolist()):
+        if end - start < min_group_size:
+            continue  # Too few loops to reach min_group_size vertices
+        vertex_indices = np.unique(sorted_vidx[start:end])
         if len(vertex_indices) >= min_group_size:
             group_name = f"{base_group_name}.{groups_created+1:02d}"
             group = obj.vertex_groups.get(group_name) or obj.vertex_groups.new(name=group_name)
-            for vertex_index in vertex_indices:
-                group.add([vertex_index], 1.0, 'REPLACE')  # Always use weight 1.0
+            group.add(vertex_indices.tolist(), 1.0, 'REPLACE')  # Always use weight 1.0
             groups_created += 1
 
     print(f"Created {groups_created} vertex groups")
     return True
 
-def assign_weights_from_texture(obj, image, group_name, normalize):
-    mesh = obj.data
-    if not mesh.uv_layers.active:
-        raise ValueError("No active UV map found. Please ensure the object has an active UV map.")
-
-    uv_layer = mesh.uv_layers.active.data
-    width, height = image.size
-    pixels = np.array(image.pixels[:]).reshape((height, width, image.channels))
-
-    group = obj.vertex_groups.get(group_name) or obj.vertex_groups.new(name=group_name)
-
-    weights = []
-    for poly in mesh.polygons:
-        for loop_idx in poly.loop_indices:
-            vertex_index = mesh.loops[loop_idx].vertex_index
-            uv = uv_layer[loop_idx].uv
-            x, y = int(uv.x * (width - 1)), int(uv.y * (height - 1))
-            pixel_value = np.mean(pixels[y, x]) if image.channels > 1 else pixels[y, x, 0]
-            weights.append((vertex_index, pixel_value))
-
-    if normalize:
-        min_weight = min(w for _, w in weights)
-        max_weight = max(w for _, w in weights)
+def assign_weights_from_texture(obj, greyscale, group_name, normalize):
+    loop_vidx, uvs = read_loops(obj.data)
+    if ndimage is not None:
+        loop_weights = sample_texture_bilinear(greyscale, uvs)
+    else:
+        loop_weights = sample_texture(greyscale, uvs)
+
+    # Average the samples of all loops sharing a vertex
+    vertex_indices, inverse = np.unique(loop_vidx, return_inverse=True)
+    weights = np.bincount(inverse, weights=loop_weights) / np.bincount(inverse)
+    if greyscale.dtype == np.uint8:
+        weights /= 255.0
+
+    if normalize and weights.size:
+        min_weight, max_weight = weights.min(), weights.max()
         weight_range = max_weight - min_weight
         if weight_range > 0:
-            weights = [(idx, (w - min_weight) / weight_range) for idx, w in weights]
+            weights -= min_weight
+            weights /= weight_range
         else:
-            weights = [(idx, 1.0) for idx, w in weights]
+            weights.fill(1.0)
 
-    for vertex_index, weight in weights:
-        group.add([vertex_index], weight, 'REPLACE')
+    np.clip(weights, 0.0, 1.0, out=weights)  # Vertex weights are limited to 0..1
+
+    group = obj.vertex_groups.get(group_name) or obj.vertex_groups.new(name=group_name)
+    # Snap to the source's precision (8 bits, or 16 bits for float images) so vertices share few distinct weights
+    steps = 255 if greyscale.dtype == np.uint8 else 65535
+    levels = np.rint(weights * steps).astype(np.uint16)
+    order = np.argsort(levels, kind='stable')
+    sorted_vidx = vertex_indices[order]
+    occupied, starts = np.unique(levels[order], return_index=True)
+    ends = np.append(starts[1:], len(sorted_vidx))
+    for level, start, end in zip(occupied.tolist(), starts.tolist(), ends.tolist()):
+        group.add(sorted_vidx[start:end].tolist(), level / steps, 'REPLACE')
 
     print(f"Created vertex group '{group_name}' with weights from texture")
     return True
@@ -244,6 +356,7 @@ def register():
 def unregister():
     bpy.utils.unregister_class(VGBT_PT_main_panel)
     bpy.utils.unregister_class(VGBT_OT_create_groups)
+    _GREY_CACHE.clear()
 
 if __name__ == "__main__":
     register()